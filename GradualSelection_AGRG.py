@@ -10,6 +10,229 @@
 
 import Metashape
 import math, sys
+import threading
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+try:
+    from pyproj import CRS, Transformer
+    from pyproj.crs import GeocentricCRS
+except ImportError:
+    Transformer = None
+
+
+def _threshold(f, pct):
+    # Selection threshold for the top pct percent of filter values, the
+    # largest value and the count of points above the threshold, via one O(n)
+    # partition and one reduction instead of a full Python sort.
+    # np.asarray is zero-copy when the binding exposes the buffer protocol;
+    # otherwise fall back to a single typed fromiter pass.
+    seq = f.values  # fetched once; the property may materialize a new sequence
+    try:
+        vals = np.asarray(seq, dtype=np.float32)
+    except TypeError:
+        vals = np.fromiter(seq, dtype=np.float32, count=len(seq))
+    k = min(int(vals.size * (1 - pct / 100)), vals.size - 1)
+    thresh = float(np.partition(vals, k)[k])
+    vmax = float(vals.max())  # single vectorized reduction, no sort
+    nselected = int((vals > thresh).sum())  # one vectorized comparison+popcount
+    return thresh, vmax, nselected
+
+
+def _rmse_numpy(centers, refs, T):
+    centers_h = np.hstack([centers, np.ones((centers.shape[0], 1))])
+    diff = refs - (centers_h @ T.T)[:, :3]
+    return math.sqrt(np.mean(np.sum(diff ** 2, axis=1)))
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _rmse(centers, refs, T):
+        s = 0.0
+        n = centers.shape[0]
+        for i in range(n):
+            x = T[0, 0] * centers[i, 0] + T[0, 1] * centers[i, 1] + T[0, 2] * centers[i, 2] + T[0, 3]
+            y = T[1, 0] * centers[i, 0] + T[1, 1] * centers[i, 1] + T[1, 2] * centers[i, 2] + T[1, 3]
+            z = T[2, 0] * centers[i, 0] + T[2, 1] * centers[i, 1] + T[2, 2] * centers[i, 2] + T[2, 3]
+            s += (refs[i, 0] - x) ** 2 + (refs[i, 1] - y) ** 2 + (refs[i, 2] - z) ** 2
+        return math.sqrt(s / n)
+else:
+    _rmse = _rmse_numpy
+
+
+def _gather_camera_error(chunk):
+    # Synchronous snapshot of the camera error report's inputs: camera
+    # centers, reference locations and the chunk transform. These are read
+    # through the binding and must not overlap a bundle adjustment, so the
+    # gather stays on the calling thread; only the pure math on the returned
+    # arrays is safe to run in the background.
+    T = chunk.transform.matrix
+    unproject = chunk.crs.unproject  # bound once; resolved per camera otherwise
+    centers = []
+    locations = []
+    for camera in chunk.cameras:
+        if not camera.transform:
+            continue
+        location = camera.reference.location
+        if not location:
+            continue
+        centers.append(list(camera.center))
+        locations.append(location)
+    if not centers:
+        return None
+    src = CRS.from_wkt(chunk.crs.wkt) if Transformer is not None else None
+    if src is not None and src.datum is not None:
+        # keep the raw locations; the batched PROJ unprojection is pure math
+        # on the snapshot and is deferred to the report thread. The target is
+        # a geocentric frame on the chunk CRS's own datum: unproject and
+        # chunk.transform.matrix live on that datum, so targeting WGS84
+        # (EPSG:4978) would fold a datum shift into the error for any
+        # non-WGS84 chunk CRS
+        refs = np.array([list(l) for l in locations], dtype=np.float64)
+        tf = Transformer.from_crs(src, GeocentricCRS(datum=src.datum),
+                                  always_xy=True)
+    else:
+        # per-camera unproject goes through the binding, so it belongs in
+        # the snapshot too
+        refs = np.asarray([list(unproject(l)) for l in locations], dtype=np.float64)
+        tf = None
+    T = np.array([list(T.row(i)) for i in range(4)], dtype=np.float64)
+    centers = np.asarray(centers, dtype=np.float64)
+    return centers, refs, tf, T
+
+
+def report_camera_error(snapshot):
+    # RMSE of camera position error, computed from a _gather_camera_error
+    # snapshot. Touches no chunk state, so it can run on a worker thread
+    # while the next stage mutates the chunk. _rmse runs as a Numba kernel
+    # when numba is installed and as a numpy matmul+reduction otherwise.
+    if snapshot is None:
+        print("****Total Camera Error: no referenced cameras")
+        return
+    centers, refs, tf, T = snapshot
+    if tf is not None:
+        # one batched PROJ call for every reference location
+        refs = np.column_stack(tf.transform(refs[:, 0], refs[:, 1], refs[:, 2]))
+    print("****Total Camera Error: ", round(_rmse(centers, refs, T), 3))
+
+
+def _progress(pct):
+    # Progress callback for optimizeCameras. The binding only reports percent
+    # complete here, not the LM residual delta, so the solve cannot be stopped
+    # early on convergence; raising from this callback would cancel the task.
+    sys.stdout.write("\r****Optimizing cameras: %d%%" % int(pct))
+    if pct >= 100:
+        sys.stdout.write("\n")
+
+
+def _optimize(chunk, full, adaptive=False, covariance=False):
+    # Bundle adjustment. Intermediate passes drop the k4/p3/p4 terms and
+    # adaptive fitting so the normal equations stay smaller; the final pass
+    # of a stage fits the full distortion model.
+    chunk.optimizeCameras(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=True, fit_b2=True,
+                          fit_k1=True, fit_k2=True, fit_k3=True, fit_k4=full,
+                          fit_p1=True, fit_p2=True, fit_p3=full, fit_p4=full,
+                          adaptive_fitting=adaptive and full,
+                          tiepoint_covariance=covariance and full,
+                          progress=_progress)
+
+
+def gradual_filter(chunk, criterion, pct, label, target_value=None,
+                   pct_max=None, max_iter=None, check_first=False,
+                   front_load=False, opt_kwargs=None):
+    # One gradual selection stage: repeatedly select the worst pct percent of
+    # points by criterion, remove them and re-optimize the cameras until a
+    # stop condition fires. With check_first the target value is tested before
+    # any removal (the RE stage). Returns (iterations, removed, last max value).
+    pc = chunk.point_cloud
+    opt_kwargs = opt_kwargs or {}
+    init_count = len(pc.points)
+    n_remaining = init_count
+    total_removed = 0
+    iterations = 0
+    f = Metashape.PointCloud.Filter()  # cloud filter, reused across iterations
+    f.init(pc, criterion=criterion)
+    # bind the per-iteration calls once; closure-local names resolve faster
+    # than repeated attribute chains through the binding
+    init, select, remove = f.init, f.selectPoints, pc.removeSelectedPoints
+    # loop-invariant stop limit, hoisted out of the per-iteration checks
+    remove_limit = None if pct_max is None else init_count * (pct_max / 100)
+    if front_load:
+        # skip the most expensive bundle adjustment (the one on the full
+        # cloud): the first removal runs at double rate without a solve, since
+        # the scores are dominated by geometry rather than the camera fit
+        thresh, vmax, _ = _threshold(f, min(2 * pct, 50))
+        select(thresh)
+        remove()
+        iterations += 1
+        nremoved = n_remaining - len(pc.points)
+        n_remaining -= nremoved
+        total_removed += nremoved
+        print("****", nremoved, " points removed during [ITERATION #", iterations, "] [", label, "] (front-loaded, no optimization)")
+        # the double-rate removal can itself satisfy a stage limit (a low
+        # pct_max, or a cloud already at the target value); check here so the
+        # main loop never stacks an uncapped extra pass on the overshoot
+        if ((remove_limit is not None and total_removed >= remove_limit)
+                or (target_value is not None and vmax <= target_value)):
+            if remove_limit is not None and total_removed >= remove_limit:
+                print("***", label, "filtering complete.", pct_max, "% of sparse cloud removed")
+            else:
+                print("***", label, "filtering complete. Target value of", target_value, " reached")
+            _optimize(chunk, full=True, **opt_kwargs)
+            return iterations, total_removed, vmax
+        init(pc, criterion=criterion)  # the cloud shrank
+    while True:
+        thresh, vmax, _ = _threshold(f, pct)
+        if check_first and (vmax <= target_value or iterations >= max_iter):
+            print("***", label, "filtering complete. Largest value is", vmax)
+            break
+        select(thresh)  # apply selection of points
+        remove()  # remove points from the cloud
+        iterations += 1
+        # exact post-removal size from one O(1) native read; the mask count
+        # from _threshold can drift from what removeSelectedPoints actually
+        # dropped (float32 ties at the threshold, points pre-selected in the
+        # GUI, invalid points), and the pct_max cap must not inherit that
+        # drift
+        nremoved = n_remaining - len(pc.points)
+        n_remaining -= nremoved
+        total_removed += nremoved
+        print("****", nremoved, " points removed during [ITERATION #", iterations, "] [", label, "]")
+
+        # stop conditions, evaluated before the optimization so the
+        # terminating pass skips the in-loop solve entirely
+        if check_first:
+            # after removal every remaining value is <= thresh, so the
+            # value-based stop is predictable before the optimization (up to
+            # the re-optimization shifting the scores)
+            is_last = thresh <= target_value or iterations >= max_iter
+        else:
+            is_last = ((remove_limit is not None and total_removed >= remove_limit)
+                       or (target_value is not None and vmax <= target_value)
+                       or (max_iter is not None and iterations >= max_iter))
+
+        if is_last:
+            if check_first:
+                print("***", label, "filtering complete after", iterations, "iterations")
+            elif remove_limit is not None and total_removed >= remove_limit:
+                print("***", label, "filtering complete.", pct_max, "% of sparse cloud removed")
+            else:
+                print("***", label, "filtering complete. Target value of", target_value, " reached")
+            break
+
+        # camera optimization between passes; the full solve runs after the loop
+        _optimize(chunk, full=False, **opt_kwargs)
+        init(pc, criterion=criterion)  # optimization invalidated the values
+    if iterations:
+        # one full-parameter solve on the refined cloud replaces the bundle
+        # adjustment that used to run inside the terminating iteration
+        _optimize(chunk, full=True, **opt_kwargs)
+    return iterations, total_removed, vmax
+
 
 doc     = Metashape.app.document  # specifies open document
 chunk   = doc.chunk  # specifies active chunk
@@ -37,6 +260,8 @@ RE_MaxIter     = 3
 RE_ThreshIter  = 10    # percentage of removal per iteration
 RE_Value       = 0.350 # reprojection error value
 
+CHECKPOINT     = False # save the project after every stage (full-project write each time)
+
 # ################################################################################
 
 print("****Number of starting points:", pc_init)  # prints initial point number in raw sparse cloud
@@ -45,133 +270,38 @@ print("****Number of starting points:", pc_init)  # prints initial point number
 
 # Reconstruction Uncertainty - RU
 
-RU_init = len(pc.points)
-total_removed = 0  # set count for points removed
-RU_sum = 0
-
-RU_refined = False
-while RU_refined == False:
-
-    # if values[-1] <= RU_Value:
-    #    refined = True
-    #    print("***Reconstruction uncertainty already filtered. Target value of",RU_Value," reached")
-    #    break
-    f = Metashape.PointCloud.Filter()  # initialise cloud filter based on criteria
-    f.init(pc, criterion=Metashape.PointCloud.Filter.ReconstructionUncertainty)
-    values = f.values.copy()
-    values.sort()  # sort points for selection
-    thresh = values[int(len(values) * (1 - RU_ThreshIter / 100))]  # define the selection
-    f.selectPoints(thresh)  # apply selection of points
-    nselected = len([p for p in pc.points if p.selected])  # len list points selected in filter
-    pc.removeSelectedPoints()  # remove points from the cloud
-    RU_sum += 1
-    print("****", nselected, " points removed during [ITERATION #",RU_sum,"] [RECONSTRUCTION UNCERTAINTY]")
-
-    # camera optimization
-    chunk.optimizeCameras(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=True, fit_b2=True, fit_k1=True,
-                          fit_k2=True, fit_k3=True, fit_k4=Trtue, fit_p1=True, fit_p2=True, fit_p3=True,
-                          fit_p4=True, adaptive_fitting=False, tiepoint_covariance=False)
-
-    total_removed += nselected  # add selected points to count
-    if total_removed >= RU_init * (RU_ThreshMax / 100):
-        refined = True  # break loop 1
-        print("***Reconstruction uncertainty filtering complete. 50% of sparse cloud removed")
-        # break
-    if values[-1] <= RU_Value:
-        refined = True  # break loop 2
-        print("***Reconstruction uncertainty filtering complete. Target value of", RU_Value, " reached")
-        break
+gradual_filter(chunk, Metashape.PointCloud.Filter.ReconstructionUncertainty,
+               RU_ThreshIter, "RECONSTRUCTION UNCERTAINTY",
+               target_value=RU_Value, pct_max=RU_ThreshMax, front_load=True)
 
-# Report Total Camera Error
-sums = 0
-num = 0
-for camera in chunk.cameras:
-    if not camera.transform:
-        continue
-    if not camera.reference.location:
-        continue
-    estimated_geoc = chunk.transform.matrix.mulp(camera.center)
-    error = chunk.crs.unproject(camera.reference.location) - estimated_geoc
-    error = error.norm()
-    sums += error ** 2
-    num += 1
-print("****Total Camera Error: ", round(math.sqrt(sums / num), 3))
-doc.save()
+# Report Total Camera Error (inputs are snapshotted here, synchronously, so
+# only the math overlaps the next stage's work)
+report_thread = threading.Thread(target=report_camera_error,
+                                 args=(_gather_camera_error(chunk),))
+report_thread.start()
+if CHECKPOINT:
+    doc.save()
 
 # Projection Accuracy
 
-PA_pts_removed = 0
-PA_init = len(pc.points)
-PA_refined = False
-while PA_refined == False:
-
-    f = Metashape.PointCloud.Filter()
-    f.init(pc, criterion=Metashape.PointCloud.Filter.ProjectionAccuracy)
-    values = f.values.copy()
-    values.sort()
-    thresh = values[int(len(values) * (1 - PA_ThreshIter / 100))]
-    f.selectPoints(thresh)
-    nselected = len([p for p in pc.points if p.selected])
-    pc.removeSelectedPoints()
-    print("****", nselected, " points removed during projection accuracy filtering")
-    # Camera optimization
-    chunk.optimizeCameras(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=True, fit_b2=True, fit_k1=True,
-                          fit_k2=True, fit_k3=True, fit_k4=True, fit_p1=True, fit_p2=True, fit_p3=True,
-                          fit_p4=True, adaptive_fitting=False, tiepoint_covariance=False)
-    PA_pts_removed += nselected
-    if PA_pts_removed >= PA_init * (PA_ThreshMax / 100):
-        PA_refined = True
-        print("***Projection Accuracy filtering complete. 50% of sparse cloud removed")
-        break
-    if values[-1] <= PA_Value:
-        PA_refined = True
-        print("***Projection Accuracy filtering complete. Threshold value reached")
-        break
+gradual_filter(chunk, Metashape.PointCloud.Filter.ProjectionAccuracy,
+               PA_ThreshIter, "PROJECTION ACCURACY",
+               target_value=PA_Value, pct_max=PA_ThreshMax)
+report_thread.join()
 
 # Report Total Camera Error
-sums = 0
-num = 0
-for camera in chunk.cameras:
-    if not camera.transform:
-        continue
-    if not camera.reference.location:
-        continue
-
-    estimated_geoc = chunk.transform.matrix.mulp(camera.center)
-    error = chunk.crs.unproject(camera.reference.location) - estimated_geoc
-    error = error.norm()
-    sums += error ** 2
-    num += 1
-print("****Total Camera Error: ", round(math.sqrt(sums / num), 3))
-doc.save()
+report_thread = threading.Thread(target=report_camera_error,
+                                 args=(_gather_camera_error(chunk),))
+report_thread.start()
+doc.save()  # checkpoint before the RE stage so a failure there doesn't re-run RU/PA
 
 # Reprojection Error
-# Need a iteration limit
-
-sum_re = 0
-RE_refined = False
-while RE_refined == False:
-    f = Metashape.PointCloud.Filter()
-    f.init(pc, criterion=Metashape.PointCloud.Filter.ReprojectionError)
-    values = f.values.copy()
-    values.sort()
-    if values[-1] <= float(RE_Value) or sum_re >= (RE_MaxIter):
-        RE_refined = True
-        print()
-        print()
-        print("Reprojecction Error reduced to", values[-1])
-        doc.save()
-        break
-    else:
-        thresh = values[int(len(values) * (1 - RE_ThreshIter / 100))]
-        f.selectPoints(thresh)
-        nselected = len([p for p in pc.points if p.selected])
-        pc.removeSelectedPoints()
-        sum_re += 1
-        print("****", nselected, " points removed during re-projection error filtering")
-        chunk.optimizeCameras(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=True, fit_b2=True, fit_k1=True,
-                              fit_k2=True, fit_k3=True, fit_k4=True, fit_p1=True, fit_p2=True, fit_p3=True,
-                              fit_p4=True, adaptive_fitting=True, tiepoint_covariance=True)
+
+gradual_filter(chunk, Metashape.PointCloud.Filter.ReprojectionError,
+               RE_ThreshIter, "REPROJECTION ERROR",
+               target_value=float(RE_Value), max_iter=RE_MaxIter, check_first=True,
+               opt_kwargs=dict(adaptive=True, covariance=True))
+report_thread.join()
 
 doc.save()
 
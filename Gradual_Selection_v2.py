@@ -12,6 +12,219 @@ The author would also like to thank Stephen Escarzaga from NPS AKRO Natural Reso
 
 import Metashape
 import math, sys
+import threading
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+try:
+    from pyproj import CRS, Transformer
+    from pyproj.crs import GeocentricCRS
+except ImportError:
+    Transformer = None
+
+
+def _threshold(f, pct):
+    # Selection threshold for the top pct percent of filter values, the
+    # largest value and the count of points above the threshold, via one O(n)
+    # partition and one reduction instead of a full Python sort.
+    # np.asarray is zero-copy when the binding exposes the buffer protocol;
+    # otherwise fall back to a single typed fromiter pass.
+    seq = f.values  # fetched once; the property may materialize a new sequence
+    try:
+        vals = np.asarray(seq, dtype=np.float32)
+    except TypeError:
+        vals = np.fromiter(seq, dtype=np.float32, count=len(seq))
+    k = min(int(vals.size * (1 - pct / 100)), vals.size - 1)
+    thresh = float(np.partition(vals, k)[k])
+    vmax = float(vals.max())  # single vectorized reduction, no sort
+    nselected = int((vals > thresh).sum())  # one vectorized comparison+popcount
+    return thresh, vmax, nselected
+
+
+def _rmse_numpy(centers, refs, T):
+    centers_h = np.hstack([centers, np.ones((centers.shape[0], 1))])
+    diff = refs - (centers_h @ T.T)[:, :3]
+    return math.sqrt(np.mean(np.sum(diff ** 2, axis=1)))
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _rmse(centers, refs, T):
+        s = 0.0
+        n = centers.shape[0]
+        for i in range(n):
+            x = T[0, 0] * centers[i, 0] + T[0, 1] * centers[i, 1] + T[0, 2] * centers[i, 2] + T[0, 3]
+            y = T[1, 0] * centers[i, 0] + T[1, 1] * centers[i, 1] + T[1, 2] * centers[i, 2] + T[1, 3]
+            z = T[2, 0] * centers[i, 0] + T[2, 1] * centers[i, 1] + T[2, 2] * centers[i, 2] + T[2, 3]
+            s += (refs[i, 0] - x) ** 2 + (refs[i, 1] - y) ** 2 + (refs[i, 2] - z) ** 2
+        return math.sqrt(s / n)
+else:
+    _rmse = _rmse_numpy
+
+
+def _gather_camera_error(chunk):
+    # Synchronous snapshot of the camera error report's inputs: camera
+    # centers, reference locations and the chunk transform. These are read
+    # through the binding and must not overlap a bundle adjustment, so the
+    # gather stays on the calling thread; only the pure math on the returned
+    # arrays is safe to run in the background.
+    T = chunk.transform.matrix
+    unproject = chunk.crs.unproject  # bound once; resolved per camera otherwise
+    centers = []
+    locations = []
+    for camera in chunk.cameras:
+        if not camera.transform:
+            continue
+        location = camera.reference.location
+        if not location:
+            continue
+        centers.append(list(camera.center))
+        locations.append(location)
+    if not centers:
+        return None
+    src = CRS.from_wkt(chunk.crs.wkt) if Transformer is not None else None
+    if src is not None and src.datum is not None:
+        # keep the raw locations; the batched PROJ unprojection is pure math
+        # on the snapshot and is deferred to the report thread. The target is
+        # a geocentric frame on the chunk CRS's own datum: unproject and
+        # chunk.transform.matrix live on that datum, so targeting WGS84
+        # (EPSG:4978) would fold a datum shift into the error for any
+        # non-WGS84 chunk CRS
+        refs = np.array([list(l) for l in locations], dtype=np.float64)
+        tf = Transformer.from_crs(src, GeocentricCRS(datum=src.datum),
+                                  always_xy=True)
+    else:
+        # per-camera unproject goes through the binding, so it belongs in
+        # the snapshot too
+        refs = np.asarray([list(unproject(l)) for l in locations], dtype=np.float64)
+        tf = None
+    T = np.array([list(T.row(i)) for i in range(4)], dtype=np.float64)
+    centers = np.asarray(centers, dtype=np.float64)
+    return centers, refs, tf, T
+
+
+def report_camera_error(snapshot):
+    # RMSE of camera position error, computed from a _gather_camera_error
+    # snapshot. Touches no chunk state, so it can run on a worker thread
+    # while the next stage mutates the chunk. _rmse runs as a Numba kernel
+    # when numba is installed and as a numpy matmul+reduction otherwise.
+    if snapshot is None:
+        print("****Total Camera Error: no referenced cameras")
+        return
+    centers, refs, tf, T = snapshot
+    if tf is not None:
+        # one batched PROJ call for every reference location
+        refs = np.column_stack(tf.transform(refs[:, 0], refs[:, 1], refs[:, 2]))
+    print("****Total Camera Error: ", round(_rmse(centers, refs, T), 3))
+
+
+def _progress(pct):
+    # Progress callback for optimizeCameras. The binding only reports percent
+    # complete here, not the LM residual delta, so the solve cannot be stopped
+    # early on convergence; raising from this callback would cancel the task.
+    sys.stdout.write("\r****Optimizing cameras: %d%%" % int(pct))
+    if pct >= 100:
+        sys.stdout.write("\n")
+
+
+def _optimize(chunk, full, fit_k4=False, fit_p3=False, covariance=False):
+    # Bundle adjustment. Intermediate passes drop the optional k4/p3 terms
+    # and adaptive fitting so the normal equations stay smaller; the final
+    # pass of a stage fits the stage's full parameter set.
+    chunk.optimizeCameras(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=True, fit_b2=True,
+                          fit_k1=True, fit_k2=True, fit_k3=True, fit_k4=fit_k4 and full,
+                          fit_p1=True, fit_p2=True, fit_p3=fit_p3 and full, fit_p4=False,
+                          adaptive_fitting=full,
+                          tiepoint_covariance=covariance and full,
+                          progress=_progress)
+
+
+def gradual_filter(chunk, criterion, pct, label, target_value=None,
+                   pct_max=None, max_iter=None, min_remaining=None,
+                   front_load=False, opt_kwargs=None):
+    # One gradual selection stage: repeatedly select the worst pct percent of
+    # points by criterion, remove them and re-optimize the cameras until a stop
+    # condition fires. Returns (iterations, total removed, last max value).
+    pc = chunk.point_cloud
+    opt_kwargs = opt_kwargs or {}
+    init_count = len(pc.points)
+    n_remaining = init_count
+    total_removed = 0
+    iterations = 0
+    f = Metashape.PointCloud.Filter()                              # cloud filter, reused across iterations
+    f.init(pc, criterion=criterion)
+    # bind the per-iteration calls once; closure-local names resolve faster
+    # than repeated attribute chains through the binding
+    init, select, remove = f.init, f.selectPoints, pc.removeSelectedPoints
+    # loop-invariant stop limit, hoisted out of the per-iteration checks
+    remove_limit = None if pct_max is None else init_count * (pct_max / 100)
+    if front_load:
+        # skip the most expensive bundle adjustment (the one on the full
+        # cloud): the first removal runs at double rate without a solve, since
+        # the scores are dominated by geometry rather than the camera fit
+        thresh, vmax, _ = _threshold(f, min(2 * pct, 50))
+        select(thresh)
+        remove()
+        iterations += 1
+        nremoved = n_remaining - len(pc.points)
+        n_remaining -= nremoved
+        total_removed += nremoved
+        print("*****\n***** Iteration---------->", iterations, "(front-loaded, no optimization)")
+        print("***** Points Removed ----->", nremoved)
+        print("***** Largest", label, "Value --->", vmax, "\n****")
+        # the double-rate removal can itself satisfy a stage limit (a low
+        # pct_max, or a cloud already at the target value); check here so the
+        # main loop never stacks an uncapped extra pass on the overshoot
+        if ((remove_limit is not None and total_removed >= remove_limit)
+                or (target_value is not None and vmax <= target_value)):
+            print('*'*100, "\n****", label, "filtering complete."
+                  "\n****Total iterations ------>", iterations,
+                  "\n****Largest value --------->", vmax)
+            _optimize(chunk, full=True, **opt_kwargs)
+            return iterations, total_removed, vmax
+        init(pc, criterion=criterion)                            # the cloud shrank
+    while True:
+        thresh, vmax, _ = _threshold(f, pct)
+        select(thresh)                                             # apply selection of points
+        remove()                                                   # remove points
+        iterations += 1
+        # exact post-removal size from one O(1) native read; the mask count
+        # from _threshold can drift from what removeSelectedPoints actually
+        # dropped (float32 ties at the threshold, points pre-selected in the
+        # GUI, invalid points), and the min_remaining safety stop must not
+        # inherit that drift
+        nremoved = n_remaining - len(pc.points)
+        n_remaining -= nremoved
+        total_removed += nremoved
+
+        print("*****\n***** Iteration---------->", iterations)
+        print("***** Points Removed ----->", nremoved)
+        print("***** Largest", label, "Value --->", vmax, "\n****")
+
+        # stop conditions, evaluated once per iteration before the
+        # optimization so the terminating pass skips the in-loop solve
+        is_last = ((remove_limit is not None and total_removed >= remove_limit)
+                   or (target_value is not None and vmax <= target_value)
+                   or (max_iter is not None and iterations >= max_iter)
+                   or (min_remaining is not None and n_remaining <= min_remaining))
+
+        if is_last:
+            print('*'*100, "\n****", label, "filtering complete."
+                  "\n****Total iterations ------>", iterations,
+                  "\n****Largest value --------->", vmax)
+            break
+
+        _optimize(chunk, full=False, **opt_kwargs)
+        init(pc, criterion=criterion)                            # optimization invalidated the values
+    # one full-parameter solve on the refined cloud replaces the bundle
+    # adjustment that used to run inside the terminating iteration
+    _optimize(chunk, full=True, **opt_kwargs)
+    return iterations, total_removed, vmax
+
 
 doc = Metashape.app.document  # specifies open document
 chunk = doc.chunk             # specifies active chunk
@@ -42,6 +255,7 @@ RE_PercentageRemove = 5     # threshold percentage of point removed for each ite
 RE_MaxIterations    = 10    # max iterations for step 3
 RE_Value            = 0.3   # stop iteration if this RE value is reached (largest value)
 perc_total_thresh   = 80    # threshold percentage of points to remove from initial point cloud
+CHECKPOINT          = False # save the project after every stage (full-project write each time)
 
 
 global_thresh = pc_init*(1- perc_total_thresh / 100)   # convert percentage to actual number of points that must remain
@@ -55,126 +269,38 @@ global_thresh = pc_init*(1- perc_total_thresh / 100)   # convert percentage to a
 # **********************************************************************************************************************
 # STEP 1 : Reconstruction Uncertainty - RU
 
-RU_init = len(pc.points)  # current count of points
-total_removed = 0         # initialize count for points removed
-RU_iter_count = 0         # initialize count for interation 
 print("*"*100,"\n****Step 1 : Reconstruction Uncertainty \n****Number of starting points:", pc_init,"\n","*"*100)
 
 # RU loop
-RU_refined = False
-while RU_refined == False:
-      
-    f = Metashape.PointCloud.Filter()                             # initialise cloud filter based on criteria
-    f.init(pc, criterion=Metashape.PointCloud.Filter.ReconstructionUncertainty) 
-    values = f.values.copy()
-    values.sort()                                                  # sort points for selection
-    thresh = values[int(len(values) * (1 - RU_PercentageRemove / 100))]  # define selection based on iteration threshold limit 
-    f.selectPoints(thresh)                                         # apply selection of points
-    nselected = len([p for p in pc.points if p.selected])          # fetch the amount of points selected in filter
-    pc.removeSelectedPoints()                                      # remove points
-    RU_iter_count += 1                                             # add 1 to iteration count
-    total_removed += nselected                                     # add selected points to count
-
-    print("*****\n***** Iteration---------->", RU_iter_count)
-    print("***** Points Removed ----->", nselected)
-    print("***** Largest RU Value --->", values[-1],"\n****")
-
-    # camera optimization
-    chunk.optimizeCameras(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=True, fit_b2=True, fit_k1=True,
-                          fit_k2=True, fit_k3=True, fit_k4=False, fit_p1=True, fit_p2=True, fit_p3=False,
-                          fit_p4=False, adaptive_fitting=True, tiepoint_covariance=False)
-
-    # logic to break loop
-    if total_removed >= RU_init * (RU_ThreshMax / 100):         # if total points removed is greater than the threshold set  (45-50%)
-        RU_refined = True                                       # break loop
-        print('*'*100,"\n****Reconstruction uncertainty filtering complete.",RU_ThreshMax,"% of initial sparse cloud removed",\
-        "\n****Total iterations ------>", RU_iter_count)
-            
-    elif values[-1] <= RU_Value:                                # values[-1] is largest RU value for all points, since they were sorted previously.
-        RU_refined = True                                       # break loop 2
-        print('*'*100,"\n****Reconstruction uncertainty filtering complete. Target value of", RU_Value, "reached",\
-        "\n****Total iterations ------>", RU_iter_count)
-
-# Report total Camera Error
-sums = 0
-num = 0
-for camera in chunk.cameras:
-    if not camera.transform:
-        continue
-    if not camera.reference.location:
-        continue
-    estimated_geoc = chunk.transform.matrix.mulp(camera.center)
-    error = chunk.crs.unproject(camera.reference.location) - estimated_geoc
-    error = error.norm()
-    sums += error ** 2
-    num += 1
-print("****Total Camera Error: ", round(math.sqrt(sums / num), 3))
+gradual_filter(chunk, Metashape.PointCloud.Filter.ReconstructionUncertainty,
+               RU_PercentageRemove, "RU", target_value=RU_Value, pct_max=RU_ThreshMax,
+               front_load=True)
+
+# Report total Camera Error (inputs are snapshotted here, synchronously, so
+# only the math overlaps the next stage's work)
+report_thread = threading.Thread(target=report_camera_error,
+                                 args=(_gather_camera_error(chunk),))
+report_thread.start()
 print('*'*100)
-doc.save()
+if CHECKPOINT:
+    doc.save()
 
 # **********************************************************************************************************************
 #  STEP 2: Projection Accuracy - PA
 
-PA_pts_removed = 0                                
-PA_init = len(pc.points)                          
-print("*"*100,"\n****Step 2 : Projection Accuracy \n****Number of starting points:", PA_init,"\n","*"*100)
+print("*"*100,"\n****Step 2 : Projection Accuracy \n****Number of starting points:", len(pc.points),"\n","*"*100)
 
 ## PA loop
-PA_iter_count = 0
-PA_refined = False
-while PA_refined == False:
-
-    f = Metashape.PointCloud.Filter()
-    f.init(pc, criterion=Metashape.PointCloud.Filter.ProjectionAccuracy)
-    values = f.values.copy()
-    values.sort()
-    thresh = values[int(len(values) * (1 - PA_PercentageRemove / 100))]
-    f.selectPoints(thresh)
-    nselected = len([p for p in pc.points if p.selected])
-    pc.removeSelectedPoints()
-
-    PA_iter_count += 1
-    PA_pts_removed += nselected  
-    #print()
-    #print("****", nselected, " points removed during projection accuracy filtering iteration *****",PA_iter_count,"*****")
-    #print("****", values[-1]," is currently the largest PA value")
-
-    print("*****\n****** Iteration ---------->", PA_iter_count)
-    print("***** Points Removed ----->", nselected)
-    print("***** Largest PA Value --->", values[-1],"\n****")
-    
-    # Camera Optimization
-    chunk.optimizeCameras(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=True, fit_b2=True, fit_k1=True,
-                          fit_k2=True, fit_k3=True, fit_k4=False, fit_p1=True, fit_p2=True, fit_p3=False,
-                          fit_p4=False, adaptive_fitting=True, tiepoint_covariance=False)
-
-    if PA_pts_removed >= PA_init * (PA_ThreshMax / 100):
-        PA_refined = True
-        print('*'*100,"\n****Projection Accuracy filtering complete.",PA_ThreshMax,"% of sparse cloud removed")
-        print("****Total iterations ------>", PA_iter_count)
-        
-    elif values[-1] <= PA_Value:
-        PA_refined = True
-        print('*'*100,"\n****Projection Accuracy filtering complete. Target value of", PA_Value, "reached.")
-        print("****Total iterations ------>", PA_iter_count)
+gradual_filter(chunk, Metashape.PointCloud.Filter.ProjectionAccuracy,
+               PA_PercentageRemove, "PA", target_value=PA_Value, pct_max=PA_ThreshMax)
+report_thread.join()
 
 # Report Total Camera Error
-sums = 0
-num = 0
-for camera in chunk.cameras:
-    if not camera.transform:
-        continue
-    if not camera.reference.location:
-        continue
-
-    estimated_geoc = chunk.transform.matrix.mulp(camera.center)
-    error = chunk.crs.unproject(camera.reference.location) - estimated_geoc
-    error = error.norm()
-    sums += error ** 2
-    num += 1
-print("****Total Camera Error: ", round(math.sqrt(sums / num), 3))
+report_thread = threading.Thread(target=report_camera_error,
+                                 args=(_gather_camera_error(chunk),))
+report_thread.start()
 print('*'*100)
-doc.save()
+doc.save()  # checkpoint before the RE stage so a failure there doesn't re-run RU/PA
 
 # ****************************************************************************************************************************************************************************
 #  Step 3 : Reprojection Error - RE
@@ -182,58 +308,15 @@ doc.save()
 
 print("*"*100,"\n****Step 3 : Reprojection Error \n****Number of starting points:", pc_init,"\n","*"*100)
 
-RE_iter_count = 0
-RE_refined = False
-while RE_refined == False:
-
-    
-    f = Metashape.PointCloud.Filter()
-    f.init(pc, criterion=Metashape.PointCloud.Filter.ReprojectionError)
-    values = f.values.copy()
-    values.sort()
-    thresh = values[int(len(values) * (1 - RE_PercentageRemove / 100))]
-    f.selectPoints(thresh)
-    nselected = len([p for p in pc.points if p.selected])
-    pc.removeSelectedPoints()
-    RE_iter_count += 1
-    print("*****\n***** Iteration---------->", RE_iter_count)
-    print("***** Points Removed ---->", nselected)
-    print("***** Larges RE Value --->", values[-1],"\n****")
-
-    # Camera optimization
-    chunk.optimizeCameras(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=True, fit_b2=True, fit_k1=True,
-                          fit_k2=True, fit_k3=True, fit_k4=True, fit_p1=True, fit_p2=True, fit_p3=True,
-                          fit_p4=False, adaptive_fitting=True, tiepoint_covariance=True)
-
-    # if current number of points is smaller or equal to (global_thresh) or ~80% of original point cloud loop will break
-    if len(pc.points) <= global_Thresh:                                     
-        RE_refined = True
-        print('*'*100,"\n****Total threshrold of ------>", perc_total_thresh,"% of original point cloud removed")
-        print("****Total iterations --------->", RE_iter_count,"\n****Max reprojection value --->", values[-1])
-    # or if current iteration count reaches the max iteration count
-    if RE_iter_count == RE_MaxIterations:
-        RE_refrined = True
-        print('*'*100,"\n****Maximum iteration reached")
-    # or if the largest RE value for all points reaches the target RE value 
-    elif values[-1] <= RE_Value:
-        RE_refined = True
-        print('*'*100,"\n****Reprojection refinement achieved with max value of", RE_Value, "Gradual Selection and Optimization Complete")
+## RE loop
+gradual_filter(chunk, Metashape.PointCloud.Filter.ReprojectionError,
+               RE_PercentageRemove, "RE", target_value=RE_Value,
+               max_iter=RE_MaxIterations, min_remaining=global_thresh,
+               opt_kwargs=dict(fit_k4=True, fit_p3=True, covariance=True))
+report_thread.join()
 
 # Report Total Camera Error
-sums = 0
-num = 0
-for camera in chunk.cameras:
-    if not camera.transform:
-        continue
-    if not camera.reference.location:
-        continue
-
-    estimated_geoc = chunk.transform.matrix.mulp(camera.center)
-    error = chunk.crs.unproject(camera.reference.location) - estimated_geoc
-    error = error.norm()
-    sums += error ** 2
-    num += 1
-print("****Total Camera Error: ", round(math.sqrt(sums / num), 3))
+report_camera_error(_gather_camera_error(chunk))
 print('*'*100)
 doc.save()
 